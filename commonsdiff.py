@@ -42,33 +42,195 @@ statements to diff (P180 is depicts).
 Optional, name of output file. If not used, a generic timestamped filename will
 be used.
 
+* --jobs 8
+
+Optional, number of files to process in parallel. Defaults to 8.
+
+* --no-cache
+
+Optional, don't read or write the cache. By default the content of old
+revisions (wikitext and SDC) is cached in ~/.cache/commonsdiff.sqlite, so that
+re-runs skip re-downloading baseline revisions.
+
 """
 
 import argparse
+import atexit
+import csv
 import datetime
+import functools
 import json
+import os
 import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import dateutil.parser as date_parser
 import pywikibot
+import pywikibot.comms.http
 import mwparserfromhell
+from mwparserfromhell.definitions import PARSER_BLACKLIST
+from mwparserfromhell.nodes import Template
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from tqdm import tqdm
 
+try:
+    import orjson  # optional, speeds up reading and writing json
+except ImportError:
+    orjson = None
+
+# matches [[Category:Name]] and [[Category:Name|sortkey]], capturing Name
+CATEGORY_REGEX = re.compile(r"\[\[Category:([^\]|]+)(?:\|[^\]]*)?\]\]", re.IGNORECASE)
+BRACES_REGEX = re.compile(r"\{\{|\}\}")
+# markup anywhere on a page that can hide the info template, or braces before
+# it, from the regex and brace counter: parameters, comments and tags whose
+# content is not parsed as wikitext (extension tags and transclusion tags)
+UNSAFE_PAGE_MARKUP = (("{{{", "<!--")
+                      + tuple("<" + tag for tag in PARSER_BLACKLIST)
+                      + ("<ref", "<poem", "<code", "<noinclude", "<includeonly",
+                         "<onlyinclude"))
+WIKIDATA_API = "https://www.wikidata.org/w/api.php"
+# (qid, language_code, fallback_language_code) -> label
+WIKIDATA_CACHE = {}
+# returned by Cache.get for absent keys, as None is a valid cached value
+CACHE_MISS = object()
+
+
+def create_wikidata_session():
+    """
+    Return a session for fetching labels straight from the Wikidata API.
+
+    Connections are pooled and kept alive between requests, and failed
+    requests are retried with a backoff.
+    """
+    session = requests.Session()
+    session.headers["User-Agent"] = "commons-diff/1.0"
+    session.headers["Accept-Encoding"] = "gzip"
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20,
+                          max_retries=Retry(total=3, backoff_factor=0.3))
+    session.mount("https://", adapter)
+    return session
+
+
+WIKIDATA_SESSION = create_wikidata_session()
+
+
+def json_loads(data):
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+@functools.lru_cache(maxsize=16)
+def parse_cutoff(stringdate):
+    # the same cutoff is used for all files, so only parse it once
+    return pywikibot.Timestamp.set_timestamp(date_parser.parse(stringdate))
+
+
+def _fetch_wd_labels(qids, language_code, fallback_language_code):
+    """
+    Return the labels of up to 50 Wikidata items, keyed by qid.
+
+    Only the labels in the two languages are fetched, not the whole items.
+    Items without a label in either language get their qid instead, so that
+    the output never ends up with an empty label.
+    """
+    response = WIKIDATA_SESSION.get(WIKIDATA_API,
+                                    params={"action": "wbgetentities",
+                                            "ids": "|".join(qids),
+                                            "props": "labels",
+                                            "languages": "{}|{}".format(
+                                                language_code, fallback_language_code),
+                                            "format": "json"})
+    # ids that don't come back (e.g. redirects, which are returned under their
+    # target) still get a value, so that they are not looked up again
+    item_labels = {qid: qid for qid in qids}
+    for qid, entity in response.json().get("entities").items():
+        labels = entity.get("labels", {})
+        item_label = labels.get(language_code) or labels.get(fallback_language_code)
+        item_labels[qid] = item_label.get("value") if item_label else qid
+    return item_labels
+
+
+def _prefetch_wd_labels(qids, language_code, fallback_language_code):
+    """Fetch the labels of the items not yet in WIKIDATA_CACHE, 50 per request."""
+    qids = sorted({qid for qid in qids
+                   if (qid, language_code, fallback_language_code) not in WIKIDATA_CACHE})
+    batches = [qids[i:i + 50] for i in range(0, len(qids), 50)]  # 50 ids per request
+    if len(batches) > 1:
+        # request the batches concurrently, but at most 8 at a time to stay polite
+        with ThreadPoolExecutor(max_workers=min(len(batches), 8)) as executor:
+            futures = [executor.submit(_fetch_wd_labels, batch, language_code,
+                                       fallback_language_code) for batch in batches]
+            results = [future.result() for future in as_completed(futures)]
+    else:
+        results = [_fetch_wd_labels(batch, language_code, fallback_language_code)
+                   for batch in batches]
+    for item_labels in results:
+        for qid, item_label in item_labels.items():
+            WIKIDATA_CACHE[(qid, language_code, fallback_language_code)] = item_label
+
 
 class Assistant(object):
 
     def get_label_from_wd_item(self, qid, language_code, fallback_language_code):
-        site = pywikibot.Site("wikidata", "wikidata")
-        repo = site.data_repository()
-        item = pywikibot.ItemPage(repo, qid)
-        item_dict = item.get()
-        item_label = item_dict["labels"].get(language_code)
-        if not item_label:
-            item_label = item_dict["labels"].get(fallback_language_code)
+        """
+        Return the label of a Wikidata item, or its qid if it has none.
+
+        Call prefetch_wd_labels first when looking up many items.
+        """
+        self.prefetch_wd_labels([qid], language_code, fallback_language_code)
+        return WIKIDATA_CACHE.get((qid, language_code, fallback_language_code))
+
+    def prefetch_wd_labels(self, qids, language_code, fallback_language_code):
+        """
+        Fetch the labels of Wikidata items into WIKIDATA_CACHE.
+
+        Labels already in the persistent cache are not fetched again, and
+        newly fetched labels are added to it.
+        """
+        if self.cache is None:
+            _prefetch_wd_labels(qids, language_code, fallback_language_code)
+            return
+        missing = []
+        for qid in set(qids):
+            key = (qid, language_code, fallback_language_code)
+            if key in WIKIDATA_CACHE:
+                continue
+            cached = self.cache.get("label:{}|{}|{}".format(*key))
+            if cached is not None:
+                WIKIDATA_CACHE[key] = cached
+            else:
+                missing.append(qid)
+        _prefetch_wd_labels(missing, language_code, fallback_language_code)
+        for qid in missing:
+            key = (qid, language_code, fallback_language_code)
+            if key in WIKIDATA_CACHE:
+                self.cache.set("label:{}|{}|{}".format(*key), WIKIDATA_CACHE[key])
 
     def array_to_string(self, array, delimiter):
         return delimiter.join(array)
 
+    def iter_csv_rows(self, results, cutoff):
+        """Yield the header row followed by one row per file."""
+        yield ["changes_after", "filename", "file_uploaded", "baseline_revision",
+               "categories_removed", "categories_added", "description_old",
+               "description_current", "statements_added", "statements_removed"]
+        for r in results:
+            yield [cutoff,
+                   r["filename"],
+                   r["uploaded"],
+                   r["baseline_revision"],
+                   self.array_to_string(r["categories"]["removed"], "|"),
+                   self.array_to_string(r["categories"]["added"], "|"),
+                   r["description"]["old"],
+                   r["description"]["new"],
+                   str(r["statements"]["added"]),
+                   str(r["statements"]["removed"])]
+
     def package_results(self, results, cutoff, source, output_format):
         config_data = self.config.dump_self()
         timestamp = datetime.datetime.now().replace(microsecond=0).isoformat()
@@ -82,65 +244,166 @@ class Assistant(object):
                            }
                    }
         elif output_format == "csv":
-            headers = ["changes_after", "filename", "file_uploaded", "baseline_revision",
-                       "categories_removed", "categories_added", "description_old",
-                       "description_current", "statements_added", "statements_removed"]
-            header_row = ("\t").join(headers)
-            result_rows = [header_row]
-            for r in results:
-                result_row = "\t".join([
-                                       cutoff,
-                                       r["filename"],
-                                       r["uploaded"],
-                                       r["baseline_revision"],
-                                       self.array_to_string(r["categories"]["removed"], "|"),
-                                       self.array_to_string(r["categories"]["added"], "|"),
-                                       r["description"]["old"],
-                                       r["description"]["new"],
-                                       str(r["statements"]["added"]),
-                                       str(r["statements"]["removed"]),
-                                      ])
-                result_rows.append(result_row)
-            packaged_results = result_rows
+            # rows are generated lazily as they are written to file
+            packaged_results = self.iter_csv_rows(results, cutoff)
         return packaged_results
 
     def results_to_file(self, data, filename, output_format):
         if output_format == "json":
             number_of_files = len(data)
-            with open(filename, "w", encoding='utf8') as datafile:
-                json.dump(data, datafile, ensure_ascii=False, sort_keys=True, indent=4)
+            if orjson:
+                with open(filename, "wb") as datafile:
+                    datafile.write(orjson.dumps(
+                        data, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
+            else:
+                with open(filename, "w", encoding='utf8') as datafile:
+                    json.dump(data, datafile, ensure_ascii=False, sort_keys=True, indent=2)
         elif output_format == "csv":
-            number_of_files = len(data) - 1
-            with open(filename, 'w', encoding='utf8') as f:
-                for line in data:
-                    f.write(f"{line}\n")
+            number_of_files = -1  # don't count the header row
+            with open(filename, 'w', encoding='utf8', newline='') as f:
+                writer = csv.writer(f, delimiter='\t', quoting=csv.QUOTE_MINIMAL,
+                                    lineterminator='\n')
+                for row in data:
+                    writer.writerow(row)
+                    number_of_files += 1
         print("Saved data of {} files to {}".format(number_of_files,
                                                     filename))
-    def read_data_filelist(self, filename):
-        datalist = []
+    def iter_filelist(self, filename):
+        """Yield the filenames in the list one at a time."""
         print("Loading files from list: {}".format(filename))
         with open(filename, 'r') as data:
             for line in data:
-                if not line.strip():  # handle trailing newlines
+                fname = line.strip()
+                if not fname:  # handle trailing newlines
                     continue
-                datalist.append(line.strip())
-        print("Loaded {} filenames.".format(len(datalist)))
-        return datalist
+                yield fname
+
+    def parse_current_revision(self, page):
+        """Return the page id, latest revision id and current content of a page."""
+        revision = page["revisions"][0]
+        slots = revision["slots"]
+        return {"pageid": page["pageid"],
+                "lastrevid": revision["revid"],
+                "current_text": slots["main"].get("content"),
+                "current_mediainfo": slots.get("mediainfo", {}).get("content")}
+
+    def fetch_current_data(self, title):
+        """
+        Return the current data of a single page, or {} if it doesn't exist.
+
+        The wikitext and the SDC (mediainfo slot) of the latest revision are
+        fetched in the same request.
+        """
+        request = self.site.simple_request(action="query",
+                                           prop="revisions",
+                                           titles=title,
+                                           rvprop="ids|content",
+                                           rvslots="*",
+                                           formatversion="2")
+        data = request.submit()
+        page = data.get("query").get("pages")[0]
+        if page.get("revisions"):
+            return self.parse_current_revision(page)
+        return {}
 
-    def read_data_category(self, categoryname):
-        datalist = []
+    def prefetch_category(self, categoryname):
+        """
+        Return the files in a category along with their current data.
+
+        The page id, latest revision id, current wikitext and current SDC of the
+        files are fetched in batches of 50, keyed by file title, so that they
+        don't have to be fetched separately for every file.
+        """
+        datalist = {}
         print("Loading files from category: {}".format(categoryname))
         cat = pywikibot.Category(self.site, categoryname)
-        for x in cat.members(member_type=['file']):
-            datalist.append(x.title())
+        base_params = {"action": "query",
+                       "generator": "categorymembers",
+                       "gcmtitle": cat.title(),
+                       "gcmtype": "file",
+                       "gcmlimit": "50",
+                       "prop": "revisions",
+                       "rvprop": "ids|content",
+                       "rvslots": "*",
+                       "formatversion": "2"}
+        params = base_params
+        while True:
+            data = self.site.simple_request(**params).submit()
+            for page in data.get("query", {}).get("pages", []):
+                file_data = datalist.setdefault(page["title"], {})
+                # content of big batches may be split over several responses
+                if page.get("revisions"):
+                    file_data.update(self.parse_current_revision(page))
+            if "continue" not in data:
+                break
+            # only send the latest continuation, a stale rvcontinue would make
+            # the API skip revisions in the next batch of pages
+            params = dict(base_params, **data["continue"])
+        print("Loaded {} filenames.".format(len(datalist)))
         return datalist
 
+    def iter_revisions(self, title, start=None, limit="max"):
+        """
+        Yield metadata for the revisions of a page, newest first.
+
+        If start is given, only revisions made at or before that time are
+        yielded. Further batches of revisions are only requested if the
+        caller keeps iterating.
+        """
+        params = {"action": "query",
+                  "prop": "revisions",
+                  "titles": title,
+                  "rvprop": "ids|timestamp|user|userid|contentmodel",
+                  "rvslots": "*",
+                  "rvlimit": limit,
+                  "formatversion": "2"}
+        if start:
+            params["rvstart"] = start.strftime("%Y-%m-%dT%H:%M:%SZ")
+        while True:
+            data = self.site.simple_request(**params).submit()
+            for page in data.get("query").get("pages"):
+                for revision in page.get("revisions", []):
+                    # API timestamps are UTC, e.g. 2023-01-10T12:00:00Z
+                    revision["timestamp"] = datetime.datetime.fromisoformat(
+                        revision["timestamp"].rstrip("Z"))
+                    yield revision
+            if "continue" not in data:
+                break
+            params.update(data.get("continue"))
+
     def create_pywikibot_timestamp(self, stringdate):
-        return pywikibot.Timestamp.set_timestamp(date_parser.parse(stringdate))
+        return parse_cutoff(stringdate)
 
-    def __init__(self, config, site):
+    def get_template_regex(self, template_name):
+        """Return a compiled regex matching the opening of the named template."""
+        regex = self.template_regexes.get(template_name)
+        if regex is None:
+            regex = re.compile(r"\{\{\s*" + re.escape(template_name) + r"\s*[|}]")
+            self.template_regexes[template_name] = regex
+        return regex
+
+    def cached(self, key, fetch):
+        """
+        Return the cached value for key, calling fetch() on a cache miss.
+
+        If caching is disabled fetch() is always called.
+        """
+        if self.cache is None:
+            return fetch()
+        value = self.cache.get(key, CACHE_MISS)
+        if value is CACHE_MISS:
+            value = fetch()
+            self.cache.set(key, value)
+        return value
+
+    def __init__(self, config, site, cache=None):
         self.config = config
         self.site = site
+        info_template = self.config.config.get("info_template")
+        self.info_template_name, self.info_field = next(iter(info_template.items()))
+        self.relevant_sdc = self.config.config.get("relevant_sdc")
+        self.cache = cache
+        self.template_regexes = {}
 
 
 class Config(object):
@@ -157,55 +420,141 @@ class Config(object):
         self.config = self.load_json_file(filepath)
 
 
+class Cache(object):
+    """Persistent store of API responses, keyed by string."""
+
+    DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "commonsdiff.sqlite")
+
+    # writes are committed in batches, so a killed run only loses the last few
+    COMMIT_INTERVAL = 100
+
+    def get(self, key, default=None):
+        """Return the value stored for key (which may be None), or default."""
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM cache WHERE key = ?",
+                                          (key,)).fetchone()
+        if row is None:
+            return default
+        return json_loads(row[0])
+
+    def set(self, key, value):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)",
+                                    (key, json.dumps(value, ensure_ascii=False)))
+            self.uncommitted_writes += 1
+            if self.uncommitted_writes >= self.COMMIT_INTERVAL:
+                self.connection.commit()
+                self.uncommitted_writes = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+    def __init__(self, filepath=DEFAULT_PATH):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        # files are processed in worker threads, which share the connection
+        self.connection = sqlite3.connect(filepath, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.uncommitted_writes = 0
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cache "
+                                "(key TEXT PRIMARY KEY, value TEXT)")
+
+
 class CommonsFile(object):
 
     def get_categories(self, page_text):
-        categories = []
-        regex_categories = r"\[\[Category\:(.*?)\]\]"
-        all_categories = re.findall(regex_categories, page_text)
-        for cat in all_categories:
-            categories.append(cat.split("|")[0])
-        return categories
+        return CATEGORY_REGEX.findall(page_text)
 
     def create_commons_page(self, filename, site):
         if not filename.startswith("File:"):
             filename = "File:{}".format(filename)
         return pywikibot.FilePage(site, filename)
 
-    def get_field_content(self, info_template, field_name, page_text):
-        parsed_wikicode = mwparserfromhell.parse(page_text)
-        templates = parsed_wikicode.filter_templates()
+    def get_template_text(self, page_text, start):
+        """Return the template starting at start, including any nested templates."""
+        depth = 0
+        for braces in BRACES_REGEX.finditer(page_text, start):
+            if braces.group() == "{{":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return page_text[start:braces.end()]
+
+    def get_field_from_templates(self, info_template, field_name, templates):
         for template in templates:
             if str(template.name).strip() == info_template:
                 if [x for x in template.params if str(x.name).strip() == field_name]:
                     content = template.get(field_name).value.strip()
                     return content
 
+    def get_field_content(self, info_template, field_name, page_text):
+        # only parse the template itself rather than the whole page, unless the
+        # page has markup that can hide braces from the brace counter
+        lowered_text = page_text.lower()
+        if not any(markup in lowered_text for markup in UNSAFE_PAGE_MARKUP):
+            template_regex = self.assistant.get_template_regex(info_template)
+            for match in template_regex.finditer(page_text):
+                template_text = self.get_template_text(page_text, match.start())
+                # tags and links can contain a }} that ends the template early,
+                # so only a slice without any of them can be trusted
+                if not template_text or "<" in template_text or "[" in template_text:
+                    break
+                nodes = mwparserfromhell.parse(template_text).nodes
+                # the slice must be exactly one template, else it was cut wrong
+                if (len(nodes) != 1 or not isinstance(nodes[0], Template)
+                        or str(nodes[0]) != template_text):
+                    break
+                content = self.get_field_from_templates(info_template, field_name, nodes)
+                if content is not None:
+                    return content
+            else:
+                return None
+        parsed_wikicode = mwparserfromhell.parse(page_text)
+        return self.get_field_from_templates(info_template, field_name,
+                                             parsed_wikicode.filter_templates())
+
     def get_revision_content(self, revision):
-        # content loading needs to be forced (only fetches it if needed)
-        revid = revision.revid
-        _ = self.commons_page.getOldVersion(revid, force=True)
+        # content of all slots is loaded together, so reuse it if getOldVersion
+        # already fetched this revision
+        revid = revision["revid"]
+        loaded_revision = self.commons_page._revisions.get(revid)
+        if loaded_revision is None or loaded_revision.text is None:
+            self.site.loadrevisions(self.commons_page, content=True, revids=revid)
         return self.commons_page._revisions[revid]
 
+    def get_old_text(self, revid):
+        # old revisions are immutable, so they can be cached forever
+        return self.assistant.cached("text:{}".format(revid),
+                                     lambda: self.commons_page.getOldVersion(revid))
+
+    def get_old_mediainfo(self, revision):
+        """Return the raw mediainfo (SDC) JSON of an old revision."""
+        def fetch():
+            revision_content = self.get_revision_content(revision)
+            return revision_content.get("slots").get("mediainfo").get("*")
+        return self.assistant.cached("rev:{}".format(revision["revid"]), fetch)
+
     def get_baseline_revision(self):
         """
-        Return the first revision after the cutoff date.
+        Return the latest revision before the cutoff date.
 
         If the file was uploaded after the cutoff date then this returns the first
         revision by another user than the uploader, or the last revision if no other
         users have interacted with the file.
         """
         baseline_date = self.assistant.create_pywikibot_timestamp(self.cutoff)
-        all_revisions = list(self.commons_page.revisions())
-        revs_before_cutoff = []
-        for revision in all_revisions:
-            if revision.timestamp < baseline_date:
-                revs_before_cutoff.append(revision)
-        if len(revs_before_cutoff) == 0:
-            baseline_revision = self.get_first_rev_not_by_uploader(all_revisions)
-        else:
-            baseline_revision = revs_before_cutoff[0]
-        return baseline_revision
+        title = self.commons_page.title()
+        # start listing at the cutoff, so only the revision we are after is fetched
+        for revision in self.assistant.iter_revisions(title, start=baseline_date, limit=1):
+            if revision["timestamp"] < baseline_date:
+                return revision
+        # uploaded after the cutoff, so the whole history is needed
+        all_revisions = list(self.assistant.iter_revisions(title))
+        if not all_revisions:
+            raise pywikibot.exceptions.NoPageError(self.commons_page)
+        return self.get_first_rev_not_by_uploader(all_revisions)
 
     def get_first_rev_not_by_uploader(self, all_revisions):
         """
@@ -221,10 +570,8 @@ class CommonsFile(object):
         return all_revisions[0]
 
     def process_descriptions(self):
-        info_template = self.assistant.config.config.get("info_template")
-
-        templ = list(info_template.keys())[0]
-        field = info_template.get(templ)
+        templ = self.assistant.info_template_name
+        field = self.assistant.info_field
 
         current_description = self.get_field_content(templ, field, self.current_page_content)
         baseline_description = self.get_field_content(templ, field, self.baseline_page_content)
@@ -233,115 +580,108 @@ class CommonsFile(object):
             descriptions["changed"] = True
         return descriptions
 
+    def list_difference(self, items, other_items):
+        """Return the items not in other_items, keeping their order."""
+        other_items = set(other_items)
+        return [x for x in items if x not in other_items]
+
     def process_categories(self):
         current_categories = self.get_categories(self.current_page_content)
         baseline_categories = self.get_categories(self.baseline_page_content)
-        added_categories = []
-        removed_categories = []
-        for cat in baseline_categories:
-            if cat not in current_categories:
-                removed_categories.append(cat)
-        for cat in current_categories:
-            if cat not in baseline_categories:
-                added_categories.append(cat)
-        return {"added":added_categories,
-                "removed": removed_categories}
+        return {"added": self.list_difference(current_categories, baseline_categories),
+                "removed": self.list_difference(baseline_categories, current_categories)}
+
+    def get_current_data(self):
+        """Return the page id, latest revision id and current content of the file."""
+        if "current_text" not in self.current_data:
+            self.current_data = self.assistant.fetch_current_data(self.commons_page.title())
+            if not self.current_data:
+                raise pywikibot.exceptions.NoPageError(self.commons_page)
+        return self.current_data
 
     def get_sdc(self):
-        mid = 'M{}'.format(self.commons_page.pageid)
-        request = self.site.simple_request(action='wbgetentities', ids=mid)
-        data = request.submit()
-        if data.get('entities').get(mid).get('pageid'):
-            return data.get('entities').get(mid)
+        current_mediainfo = self.get_current_data().get("current_mediainfo")
+        if current_mediainfo:
+            return json_loads(current_mediainfo)
         return {}
 
-    def process_captions(self):
+    def get_old_sdc(self):
+        """Return the SDC of the baseline revision, or None if it had none."""
+        old_mediainfo = self.baseline_revision.get("slots").get("mediainfo")
+        if old_mediainfo:
+            return json_loads(self.get_old_mediainfo(self.baseline_revision))
 
+    def extract_sdc(self, sdc):
+        """
+        Return the captions and relevant statements of SDC in a single pass.
+
+        Captions are (language, caption) tuples and statements are
+        (property, value) tuples, so that both are hashable.
+        """
         captions = []
-        old_captions = []
-        added_captions = []
-        removed_captions = []
-        labels = self.sdc.get("labels")
-        if labels:
-            for key in labels.keys():
-                captions.append({key:labels.get(key).get('value')})
+        statements = []
+        if not sdc:
+            return captions, statements
+        labels = sdc.get("labels") or {}
+        for key, label in labels.items():
+            if not label.get('value'):  # deleted captions result in empty values
+                continue
+            captions.append((key, label['value']))
+        # an empty mediainfo slot stores the statements as an empty list
+        all_statements = sdc.get("statements") or {}
+        for statement_property in self.assistant.relevant_sdc:
+            for y in all_statements.get(statement_property, []):
+                statement_value = y.get("mainsnak").get("datavalue").get("value").get("id")
+                statements.append((statement_property, statement_value))
+        return captions, statements
+
+    def process_captions(self):
+        captions = self.current_captions
+        old_captions = self.old_captions
 
-        old_mediainfo = self.baseline_revision.get("slots").get("mediainfo")
-        if old_mediainfo:
-            old_revision_content = self.get_revision_content(self.baseline_revision)
-            old_sdc_content = json.loads(old_revision_content.get("slots").get("mediainfo").get("*"))
-            old_sdc_labels = old_sdc_content.get("labels")
-            if old_sdc_labels:
-                for key in old_sdc_labels.keys():
-                    if not labels.get(key):  # deleted captions result in empty values
-                        continue
-                    old_captions.append({key:labels.get(key).get('value')})
-        
         # now we compare old and new captions
-        for captionpair in captions:
-            if captionpair not in old_captions:
-                added_captions.append(captionpair)
-        for captionpair in old_captions:
-            if captionpair not in captions:
-                removed_captions.append(captionpair)
+        added_captions = self.list_difference(captions, old_captions)
+        removed_captions = self.list_difference(old_captions, captions)
 
-        return {"added": added_captions, "removed": removed_captions}
+        return {"added": [{key: value} for key, value in added_captions],
+                "removed": [{key: value} for key, value in removed_captions]}
 
     def process_statements(self):
-        current_statements = []
-        old_statements = []
-        added_statements = []
-        removed_statements = []
-        relevant_sdc = self.assistant.config.config.get("relevant_sdc")
-
-        all_statements = self.sdc.get("statements")
-        if all_statements:
-            for x in all_statements:
-                if x in relevant_sdc:
-                    for y in all_statements.get(x):
-                        statement_property = x
-                        statement_value = y.get("mainsnak").get("datavalue").get("value").get("id")
-                        current_statements.append((statement_property, statement_value))
-
-        old_mediainfo = self.baseline_revision.get("slots").get("mediainfo")
-        if old_mediainfo:
-            old_revision_content = self.get_revision_content(self.baseline_revision)
-            old_sdc_content = json.loads(old_revision_content.get("slots").get("mediainfo").get("*"))
-            old_sdc_statements = old_sdc_content.get("statements")
-            for x in old_sdc_statements:
-                if x in relevant_sdc:
-                    for y in old_sdc_statements.get(x):
-                        old_statement_property = x
-                        old_statement_value = y.get("mainsnak").get("datavalue").get("value").get("id")
-                        old_statements.append((old_statement_property, old_statement_value))
-
-        for stmnt in current_statements:
-            if stmnt not in old_statements:
-                added_statements.append(stmnt)
-        for stmnt in old_statements:
-            if stmnt not in current_statements:
-                removed_statements.append(stmnt)
-
-        return {"added": added_statements, "removed": removed_statements}
+        current_statements = self.current_statements
+        old_statements = self.old_statements
+        return {"added": self.list_difference(current_statements, old_statements),
+                "removed": self.list_difference(old_statements, current_statements)}
 
     def get_creation_date(self):
         return self.commons_page.oldest_revision.timestamp.isoformat()
 
     def process_history(self):
         self.baseline_revision = self.get_baseline_revision()
-        self.baseline_page_content = self.commons_page.getOldVersion(self.baseline_revision.revid)
-        self.current_page_content = self.commons_page.text
-        self.sdc = self.get_sdc()
-        self.file_history_data["baseline_revision"] = str(self.baseline_revision.revid)
+        self.current_page_content = self.get_current_data().get("current_text")
+        if self.baseline_revision["revid"] == self.get_current_data().get("lastrevid"):
+            # nothing changed since the cutoff, so there is no need to fetch
+            # anything else; the diffs below will all come out empty
+            self.baseline_page_content = self.current_page_content
+            self.sdc = {}
+            self.old_sdc = None
+        else:
+            self.baseline_page_content = self.get_old_text(self.baseline_revision["revid"])
+            self.sdc = self.get_sdc()
+            self.old_sdc = self.get_old_sdc()
+        self.current_captions, self.current_statements = self.extract_sdc(self.sdc)
+        self.old_captions, self.old_statements = self.extract_sdc(self.old_sdc)
+        self.file_history_data["baseline_revision"] = str(self.baseline_revision["revid"])
         self.file_history_data["categories"] = self.process_categories()
         self.file_history_data["description"] = self.process_descriptions()
         self.file_history_data["captions"] = self.process_captions()
         self.file_history_data["statements"] = self.process_statements()
         self.file_history_data["uploaded"] = self.get_creation_date()
 
-    def __init__(self, filename, assistant, cutoff, site):
+    def __init__(self, filename, assistant, cutoff, site, prefetched=None):
         self.commons_page = self.create_commons_page(filename, site)
         self.site = site
+        # current data of the file if it was already fetched in a batch
+        self.current_data = prefetched or {}
         self.cutoff = cutoff
         self.assistant = assistant
         self.file_history_data = {"filename": filename,
@@ -352,12 +692,37 @@ class CommonsFile(object):
                                   "uploaded": ""}
 
 
+def configure_http_pool(max_workers):
+    """
+    Let pywikibot keep one open connection per worker thread.
+
+    By default requests only keeps 10 connections per host alive, so with more
+    workers than that connections would be discarded and every request would
+    have to do a new TCP+TLS handshake.
+    """
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers * 2)
+    pywikibot.comms.http.session.mount("https://", adapter)
+
+
+def process_file(fname, assistant, cutoff, site, prefetched=None):
+    """Return the history data of a single file, or None if it doesn't exist."""
+    try:
+        commons_file = CommonsFile(fname, assistant, cutoff, site, prefetched)
+        commons_file.process_history()
+    except pywikibot.exceptions.NoPageError:
+        return None
+    return commons_file.file_history_data
+
+
 def main(arguments):
     site = pywikibot.Site("commons", "commons")
     cutoff = arguments.get("cutoff")
-    assistant = Assistant(Config(arguments.get("config")), site)
-
-    history_dump = []
+    if arguments.get("no_cache"):
+        cache = None
+    else:
+        cache = Cache()
+        atexit.register(cache.close)
+    assistant = Assistant(Config(arguments.get("config")), site, cache)
 
     if arguments.get("format"):
         if arguments.get("format").lower() in ["csv", "json"]:
@@ -373,18 +738,31 @@ def main(arguments):
 
     if arguments.get("category"):
         source = "Category:{}".format(arguments.get("category"))
-        files = assistant.read_data_category(arguments.get("category"))
+        prefetched = assistant.prefetch_category(arguments.get("category"))
+        files = list(prefetched)
     elif arguments.get("list"):
         source = arguments.get("list")
-        files = assistant.read_data_filelist(arguments.get("list"))
+        prefetched = {}
+        files = assistant.iter_filelist(arguments.get("list"))
     print("Output format: ", output_format)
-    for fname in tqdm(files, desc="Processing files", disable=arguments.get("quiet")):
+    max_workers = arguments.get("jobs") or 8
+    configure_http_pool(max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(process_file, fname, assistant, cutoff, site,
+                                   prefetched.get(fname)): i
+                   for i, fname in enumerate(files)}
+        file_history = [None] * len(futures)
         try:
-            commons_file = CommonsFile(fname, assistant, cutoff, site)
-            commons_file.process_history()
-        except pywikibot.exceptions.NoPageError:
-            continue
-        history_dump.append(commons_file.file_history_data)
+            for future in tqdm(as_completed(futures), total=len(futures),
+                               desc="Processing files", disable=arguments.get("quiet")):
+                file_history[futures[future]] = future.result()
+        except BaseException:
+            # fail fast: drop the queued files rather than processing them all
+            # before the error is raised
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    # keep the order of the input
+    history_dump = [data for data in file_history if data is not None]
 
     results = assistant.package_results(history_dump, cutoff, source, output_format)
 
@@ -400,6 +778,8 @@ if __name__ == "__main__":
     parser.add_argument("--config", required=True)
     parser.add_argument("--out", required=False)
     parser.add_argument("--format")
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--jobs", type=int)
     parser.add_argument('-q', '--quiet', action='store_true')
     args = parser.parse_args()
     main(vars(args))